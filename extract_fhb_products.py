@@ -1,7 +1,12 @@
-import requests, subprocess, json, base64
+import os, requests, base64
+import orjson
 import polars as pl
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from pytz import timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 def get_auth(api_name):
@@ -18,114 +23,191 @@ def get_auth(api_name):
     return auth_dict
 
 
-def _get_schema_from_json(json):
+def _get_products_df(json_file_path, keys_file_path, schema_path):
     """
-    Generate a schema dictionary from a given JSON object.
-    This function takes a JSON object, infers its schema using the `pl.from_dicts` method,
-    and then converts the schema to a dictionary. It ensures that columns with `Null` or
-    `Boolean` types are converted to `Utf8` type.
+    Read a newline-delimited JSON file of products into a DataFrame.
+    This function reuses the schema cached at `schema_path` when it covers every field
+    listed in `keys_file_path`, as `pl.read_ndjson` silently drops fields missing from
+    its schema. Otherwise, or when the file no longer parses with the cached schema, it
+    infers the schema from every record and overwrites the cache. `Null` columns are
+    cached as `Utf8`, so values arriving in later runs still load.
     Args:
-        json (list): A list of dictionaries representing the JSON object.
+        json_file_path (str): The path of the newline-delimited JSON file.
+        keys_file_path (str): The path of the JSON list of fields present in the file.
+        schema_path (str): The path of the Arrow IPC file the schema is cached in.
     Returns:
-        dict: A dictionary where keys are column names and values are their inferred types.
+        polars.DataFrame: The products read from the file.
     """
-    schema_dict = dict(pl.from_dicts(json, infer_schema_length=None).schema)
-    schema = {}
+    if os.path.exists(schema_path) and os.path.exists(keys_file_path):
+        schema = pl.read_ipc_schema(schema_path)
+        with open(keys_file_path, "rb") as keys_file:
+            keys = orjson.loads(keys_file.read())
+        if set(keys) <= schema.keys():
+            try:
+                return pl.read_ndjson(json_file_path, schema=schema)
+            except pl.exceptions.ComputeError:
+                pass
+
+    products_df = pl.read_ndjson(json_file_path, infer_schema_length=None)
+    schema = {
+        name: pl.Utf8 if type == pl.Null else type
+        for name, type in products_df.schema.items()
+    }
+    pl.DataFrame(schema=schema).write_ipc(schema_path)
+    return products_df
 
-    for name, type in schema_dict.items():
-        if type == pl.Null:
-            schema.update({name: pl.Utf8})
-        elif type == pl.Boolean:
-            schema.update({name: pl.Utf8})
-        else:
-            schema.update({name: type})
-    return schema
 
+def _get_session(pool_size=16):
+    """
+    Create a requests session with a pooled, retrying HTTP adapter.
+    Args:
+        pool_size (int): The number of connections kept open per host, matching the page fetch workers.
+    Returns:
+        requests.Session: A session with the adapter mounted for http and https.
+              GET requests are retried with exponential backoff on connection
+              errors and on 429/5xx responses.
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
-def get_json_fhb_products(run_date, data_path, url, headers):
+
+def _get_products_page(session, headers, page_url):
     """
-    Fetches product data from the given URL and saves it as a JSON file.
+    Fetch a single page of products from the FHB API.
     Args:
-        run_date (datetime): The date of the run, used to create a unique directory for the output file.
+        session (requests.Session): The session used to issue the request.
+        headers (dict): The headers to include in the API request.
+        page_url (str): The URL of the page to fetch.
+    Returns:
+        list: A list of dictionaries representing the products on the page.
+    """
+    product_page = session.get(page_url, headers=headers)
+    product_page.raise_for_status()
+    return orjson.loads(product_page.content)["products"]
+
+
+def get_json_fhb_products(run_date_key, data_path, url, headers, session):
+    """
+    Fetches product data from the given URL and saves it as a newline-delimited JSON file,
+    along with the list of fields present in the records.
+    Args:
+        run_date_key (str): The date of the run formatted as YYYYMMDD, used to create a unique directory for the output file.
         data_path (str): The base path where the JSON file will be saved.
         url (str): The base URL for the API endpoint.
         headers (dict): The headers to include in the API requests.
+        session (requests.Session): The session used to issue the API requests.
     Returns:
         None
     Raises:
         requests.exceptions.RequestException: If there is an issue with the API request.
-        subprocess.CalledProcessError: If there is an issue creating the directory.
-        IOError: If there is an issue writing the JSON file.
+        OSError: If there is an issue creating the directory.
+        IOError: If there is an issue writing the JSON file or its list of fields.
     Example:
-        get_json_fhb_products(datetime.now(), '/path/to/data', 'https://api.example.com', {'Authorization': 'Bearer token'})
+        get_json_fhb_products('20240101', '/path/to/data', 'https://api.example.com', {'Authorization': 'Bearer token'}, _get_session())
     """
-    run_date_key = run_date.strftime("%Y%m%d")
-
-    product_all = requests.get(f"{url}/product/all", headers=headers)
-    product_all_cnt = product_all.json()["total"]
-    product_all_pages = int(product_all_cnt / 250) + 1
+    product_all = session.get(f"{url}/product/all", headers=headers)
+    product_all_cnt = orjson.loads(product_all.content)["total"]
+    product_all_pages = -(-product_all_cnt // 250)
 
-    product_all_list = []
+    os.makedirs(f"{data_path}/landing/products/{run_date_key}", exist_ok=True)
+    json_file_path = (
+        f"{data_path}/landing/products/{run_date_key}/" + "products_raw.ndjson"
+    )
 
-    for p in range(product_all_pages):
-        product_page = requests.get(f"{url}/product/all?page={p+1}", headers=headers)
-        product_all_list += product_page.json()["products"]
+    json_tmp_file_path = f"{json_file_path}.tmp"
+    keys_file_path = (
+        f"{data_path}/landing/products/{run_date_key}/" + "products_keys.json"
+    )
 
-    if product_all_cnt == len(product_all_list):
+    page_urls = [f"{url}/product/all?page={p+1}" for p in range(product_all_pages)]
+    product_cnt = 0
+    product_keys = set()
+
+    with ThreadPoolExecutor(max_workers=16) as executor, open(
+        json_tmp_file_path, "wb"
+    ) as json_file:
+        for products in executor.map(
+            partial(_get_products_page, session, headers), page_urls
+        ):
+            for product in products:
+                json_file.write(orjson.dumps(product, option=orjson.OPT_APPEND_NEWLINE))
+                product_keys.update(product)
+                product_cnt += 1
+
+    with open(keys_file_path, "wb") as keys_file:
+        keys_file.write(orjson.dumps(sorted(product_keys)))
+    os.replace(json_tmp_file_path, json_file_path)
+
+    if product_all_cnt == product_cnt:
         print("CHECK: Product count PASSED!")
     else:
         print("CHECK: Product count FAILED!")
 
-    subprocess.check_output(
-        f"mkdir -p {data_path}/landing/products/{run_date_key}", shell=True
-    )
-    json_file_path = (
-        f"{data_path}/landing/products/{run_date_key}/" + "products_raw.json"
-    )
-
-    with open(json_file_path, "w") as json_file:
-        json.dump(product_all_list, json_file, indent=2)
     print(
         f"Data has been successfully written to {json_file_path} with page_count: {product_all_pages}"
     )
 
 
-def get_fhb_products(run_date, data_path, url, headers):
+def get_fhb_products(run_date_key, data_path, url, headers):
     """
     Fetches FHB products data, processes it, and saves it as a parquet file.
     Args:
-        run_date (datetime): The date of the run, used to generate file paths.
+        run_date_key (str): The date of the run formatted as YYYYMMDD, used to generate file paths.
         data_path (str): The base path where data files are stored.
         url (str): The URL to fetch data from (not used in the current implementation).
         headers (dict): Headers for the HTTP request (not used in the current implementation).
     Returns:
         None
     Side Effects:
-        - Reads a JSON file containing product data.
         - Creates a directory for saving processed data.
-        - Converts the JSON data to a DataFrame with an additional 'run_date_key' column.
-        - Writes the DataFrame to a parquet file.
+        - Reads a newline-delimited JSON file containing product data into a DataFrame,
+          reusing or refreshing the schema cached in the preprocess directory.
+        - Casts `Null` and `Boolean` columns to `Utf8` and adds a 'run_date_key' column.
+        - Writes the DataFrame to a 'run_date_key=<run_date_key>' partition directory.
         - Prints a success message with the path and shape of the saved data.
     """
-    run_date_key = run_date.strftime("%Y%m%d")
     json_file_path = (
-        f"{data_path}/landing/products/{run_date_key}/" + "products_raw.json"
+        f"{data_path}/landing/products/{run_date_key}/" + "products_raw.ndjson"
     )
-    save_path = f"{data_path}/preprocess/products/{run_date_key}"
+    keys_file_path = (
+        f"{data_path}/landing/products/{run_date_key}/" + "products_keys.json"
+    )
+    save_path = f"{data_path}/preprocess/products/run_date_key={run_date_key}"
+    schema_path = f"{data_path}/preprocess/products/_schema.arrow"
 
-    with open(json_file_path, "r") as json_file:
-        products = json.load(json_file)
+    os.makedirs(save_path, exist_ok=True)
 
-    subprocess.check_output(f"mkdir -p {save_path}", shell=True)
+    products_df = _get_products_df(json_file_path, keys_file_path, schema_path)
 
-    products_schema = _get_schema_from_json(products)
-    products_df = pl.from_dicts(products, schema=products_schema).with_columns(
-        pl.lit(run_date_key).alias("run_date_key")
+    products_df = products_df.with_columns(
+        [
+            pl.col(name).cast(pl.Utf8)
+            for name, type in products_df.schema.items()
+            if type in (pl.Null, pl.Boolean)
+        ]
+        + [pl.lit(run_date_key).alias("run_date_key")]
+    )
+    products_df.write_parquet(
+        f"{save_path}/products.parquet",
+        compression="lz4",
+        statistics=True,
+        row_group_size=500_000,
+        data_page_size=1 << 20,
     )
-    products_df.write_parquet(f"{save_path}/products.parquet")
 
     print(
-        f"Data has been successfully written to {save_path} with shape: {pl.from_dicts(products, infer_schema_length=None).shape}"
+        f"Data has been successfully written to {save_path} with shape: {products_df.shape}"
     )
 
 
@@ -134,21 +216,24 @@ def main():
     Main function to preprocess landing data from FHB API.
     This function performs the following steps:
     1. Sets the API URL and data path.
-    2. Gets the current date and time in the 'Europe/Bratislava' timezone.
-    3. Authenticates with the FHB API and retrieves an authentication token.
-    4. Encodes the token in base64 format.
-    5. Sets up the headers for API requests.
-    6. Calls functions to get JSON FHB products and FHB products.
+    2. Gets the current date in the 'Europe/Bratislava' timezone as a YYYYMMDD run date key.
+    3. Opens a session that keeps connections to the FHB API alive across requests.
+    4. Authenticates with the FHB API and retrieves an authentication token.
+    5. Encodes the token in base64 format.
+    6. Sets up the headers for API requests.
+    7. Calls functions to get JSON FHB products and FHB products.
     Raises:
         requests.exceptions.RequestException: If there is an issue with the API request.
         KeyError: If the 'token' key is not found in the login response.
     """
     url = "https://api.fhb.sk/v3"
     data_path = "/home/data/"
-    run_date = datetime.now(timezone("Europe/Bratislava"))
+    run_date_key = datetime.now(timezone("Europe/Bratislava")).strftime("%Y%m%d")
+
+    session = _get_session()
 
-    login = requests.post(f"{url}/login", data=json.dumps(get_auth("fhb")))
-    token_raw = login.json()["token"]
+    login = session.post(f"{url}/login", data=orjson.dumps(get_auth("fhb")))
+    token_raw = orjson.loads(login.content)["token"]
     token = base64.b64encode(token_raw.encode("utf-8")).decode("utf-8")
 
     headers = {
@@ -156,8 +241,8 @@ def main():
         "X-Authentication-Simple": token,
     }
 
-    get_json_fhb_products(run_date, data_path, url, headers)
-    get_fhb_products(run_date, data_path, url, headers)
+    get_json_fhb_products(run_date_key, data_path, url, headers, session)
+    get_fhb_products(run_date_key, data_path, url, headers)
 
 
 if __name__ == "__main__":
@@ -2,46 +2,62 @@ import os
 import polars as pl
 
 
-def present_fhb(data_path):
+def present_fhb(data_path, cutoff=None):
     """
     Processes product data from parquet files, aggregates it, and saves the result.
     Args:
         data_path (str): The base directory path where the product data is stored and where the processed data will be saved.
+        cutoff (str, optional): The earliest run_date_key (YYYYMMDD) to read. Older files are skipped using
+            their parquet statistics, so update_date_key reflects history from the cutoff onwards. Defaults to None (full history).
     The function performs the following steps:
-    1. Reads product data from parquet files located in the specified data_path.
-    2. Aggregates the product data by grouping on several columns and calculating the minimum run_date_key.
+    1. Lazily scans product data from parquet files located in the specified data_path, covering both the
+       '<run_date_key>/' and 'run_date_key=<run_date_key>/' partition layouts.
+    2. Deduplicates the product data by grouping on several columns and calculating the minimum run_date_key.
     3. Adds a 'current_flag' column to indicate the most recent update for each product.
-    4. Saves the processed product data to a new parquet file in the 'present/products' directory within the specified data_path.
+    4. Collects the lazy query with the streaming engine.
+    5. Saves the processed product data to a new parquet file in the 'present/products' directory within the specified data_path.
     """
     parquet_file_path = data_path + "/preprocess/products/*/products.parquet"
-    products_import = pl.read_parquet(parquet_file_path).unique()
+    products_import = pl.scan_parquet(parquet_file_path, hive_partitioning=False)
+    if cutoff is not None:
+        products_import = products_import.filter(pl.col("run_date_key") >= cutoff)
 
+    products = products_import.group_by(
+        "internal_code",
+        "ean",
+        "name",
+        "photo",
+        "archived",
+        "stock_quantity",
+        "free_quantity",
+        maintain_order=False,
+    ).agg(pl.min("run_date_key").alias("update_date_key"))
+    latest = products.group_by("internal_code", maintain_order=False).agg(
+        pl.max("update_date_key").alias("max_update_date_key")
+    )
     products = (
-        products_import.group_by(
-            "internal_code",
-            "ean",
-            "name",
-            "photo",
-            "archived",
-            "stock_quantity",
-            "free_quantity",
-        )
-        .agg(pl.min("run_date_key").alias("update_date_key"))
+        products.join(latest, on="internal_code", how="left", nulls_equal=True)
         .with_columns(
-            pl.when(
-                pl.max("update_date_key").over("internal_code")
-                == pl.col("update_date_key")
-            )
+            pl.when(pl.col("update_date_key") == pl.col("max_update_date_key"))
             .then(pl.lit("Y"))
             .alias("current_flag")
         )
+        .drop("max_update_date_key")
+        .collect(engine="streaming")
     )
 
     save_path = f"{data_path}/present/products"
     os.makedirs(save_path, exist_ok=True)
     parquet_file_path = f"{save_path}/products.parquet"
     print(parquet_file_path)
-    products.write_parquet(parquet_file_path)
+    products.write_parquet(
+        parquet_file_path,
+        compression="zstd",
+        compression_level=3,
+        statistics=True,
+        row_group_size=500_000,
+        data_page_size=1 << 20,
+    )
 
 
 def main():